@@ -4,12 +4,16 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
+from array import array
 from . import filament_switch_sensor
 
 ADC_REPORT_TIME = 0.500
 ADC_SAMPLE_TIME = 0.015
 ADC_SAMPLE_COUNT = 32
 
+# extrusion multiplier update interval (seconds) while the filament is moving
+UPDATE_TIME = 1.0
+
 class FilaSense:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -19,21 +23,54 @@ class FilaSense:
         self.diameter_2 = config.getfloat('diameter_2', 2.0)
         self.raw_1 = config.getint('raw_1', 6250)
         self.raw_2 = config.getint('raw_2', 8750)
-        self.measurement_interval = config.getint('measurement_interval', 10)
+        if self.raw_1 == self.raw_2:
+            raise config.error("raw_1 and raw_2 must differ")
+        # linear mapping from raw sensor value to diameter
+        self._slope = ((self.diameter_2 - self.diameter_1)
+                       / (self.raw_2 - self.raw_1))
+        self._offset = self.diameter_1 - self._slope * self.raw_1
+        self.measurement_interval = config.getint('measurement_interval', 10,
+                                                  minval = 1)
         self.nominal_diameter = config.getfloat('nominal_diameter', above = 1.0)
         self.measurement_delay = config.getfloat('measurement_delay', above = 0.0)
         self.max_difference = config.getfloat('max_difference', 0.2)
         self.max_diameter = self.nominal_diameter + self.max_difference
         self.min_diameter = self.nominal_diameter - self.max_difference
+        # numerator of the extrusion multiplier percentage
+        self._m221_num = self.nominal_diameter * self.nominal_diameter * 100.0
         self.diameter = self.nominal_diameter
         self.enabled = config.getboolean('enabled', False)
         self.runout_min_diameter = config.getfloat('runout_min_diameter', 1.0)
         self.runout_max_diameter = config.getfloat('runout_max_diameter', self.max_diameter)
         self.logging = config.getboolean('logging', False)
+        # maximum update interval while the filament is not moving
+        self.idle_interval_max = config.getfloat('idle_interval_max', 5.0,
+                                                 minval = UPDATE_TIME)
         # use the current diameter instead of nominal while the first measurement isn't in place
         self.use_current_diameter_while_delay = config.getboolean('use_current_diameter_while_delay', False)
-        # FIFO with tuples (epos, diameter)
-        self.fifo = []
+        # FIFO of (epos, diameter) measurements, kept in a preallocated
+        # ring buffer
+        fifo_size = max(8, int(self.measurement_delay
+                               / self.measurement_interval) + 4)
+        self._fifo_epos = array('d', [0.0] * fifo_size)
+        self._fifo_diam = array('d', [0.0] * fifo_size)
+        self._head = self._tail = self._size = 0
+        # projected extruder position at which the next measurement is due
+        self._next_epos_threshold = float('-inf')
+        # extruder position of the FIFO head entry, infinity if empty
+        self._head_epos = float('inf')
+        # diameter used by the last full update, and whether a full update
+        # is needed
+        self._last_cb_diameter = 0.0
+        self._update_needed = True
+        # filament presence seen by the last update, number of consecutive
+        # updates without extruder movement or presence change, and
+        # extruder position seen by the last update
+        self._filament_present = False
+        self._idle_ticks = 0
+        self._last_epos = 0.0
+        # extrusion multiplier determined by the last full update
+        self._extrude_factor = None
         self.raw = 0
         self.diameter = 0
         # printer objects
@@ -48,13 +85,16 @@ class FilaSense:
         self.timer = self.reactor.register_timer(self.timer_callback)
         # register commands
         self.gcode = self.printer.lookup_object('gcode')
-        self.gcode.register_command('QUERY_FILAMENT_DIAMETER', self.cmd_QUERY_FILAMENT_DIAMETER)
-        self.gcode.register_command('RESET_FILAMENT_DIAMETER_SENSOR', self.cmd_RESET_FILAMENT_DIAMETER_SENSOR)
-        self.gcode.register_command('ENABLE_FILAMENT_DIAMETER_SENSOR', self.cmd_ENABLE_FILAMENT_DIAMETER_SENSOR)
-        self.gcode.register_command('DISABLE_FILAMENT_DIAMETER_SENSOR', self.cmd_DISABLE_FILAMENT_DIAMETER_SENSOR)
-        self.gcode.register_command('QUERY_RAW_FILAMENT_DIAMETER', self.cmd_QUERY_RAW_FILAMENT_DIAMETER)
-        self.gcode.register_command('ENABLE_FILAMENT_DIAMETER_LOG', self.cmd_ENABLE_FILAMENT_DIAMETER_LOG)
-        self.gcode.register_command('DISABLE_FILAMENT_DIAMETER_LOG',self.cmd_DISABLE_FILAMENT_DIAMETER_LOG)
+        self.gcode_move = self.printer.load_object(config, 'gcode_move')
+        handlers = [
+            'QUERY_FILAMENT_DIAMETER', 'RESET_FILAMENT_DIAMETER_SENSOR',
+            'ENABLE_FILAMENT_DIAMETER_SENSOR',
+            'DISABLE_FILAMENT_DIAMETER_SENSOR',
+            'QUERY_RAW_FILAMENT_DIAMETER',
+            'ENABLE_FILAMENT_DIAMETER_LOG', 'DISABLE_FILAMENT_DIAMETER_LOG',
+        ]
+        for cmd in handlers:
+            self.gcode.register_command(cmd, getattr(self, 'cmd_' + cmd))
 
         self.runout_helper = filament_switch_sensor.RunoutHelper(config)
 
@@ -67,49 +107,118 @@ class FilaSense:
     # ADC callback
     def adc_callback(self, read_time, read_value):
         # read raw sensor value
-        self.raw = round(read_value * 10000)
+        raw = read_value * 10000.0
+        self.raw = round(raw)
         # update diameter
-        self.diameter = round((self.diameter_2 - self.diameter_1) / (self.raw_2 - self.raw_1) * (self.raw - self.raw_1) + self.diameter_1, 2)
+        diameter = self.diameter = self._slope * raw + self._offset
+        # request a full update if the delay phase extrusion multiplier
+        # would change
+        if (self.use_current_diameter_while_delay
+            and self._m221_percentage(diameter)
+            != self._m221_percentage(self._last_cb_diameter)):
+            self._update_needed = True
 
     # extrusion multiplier update timer callback
     def timer_callback(self, eventtime):
-        pos = self.toolhead.get_position()
-        epos = pos[3]
+        if not self.enabled:
+            return self.reactor.NEVER
+        # bind frequently used attributes to locals
+        diameter = self.diameter
+        nominal_diameter = self.nominal_diameter
+        fifo_epos = self._fifo_epos
+        fifo_diam = self._fifo_diam
+        fifo_size = len(fifo_epos)
+        _, _, _, epos = self.toolhead.get_position()
         # determine projected extruder position when the current diameter will be active
         epos_projected = epos + self.measurement_delay
-        # append projected extruder position and diameter to FIFO tail if measurement interval has passed or FIFO is empty
-        if not self.fifo or epos_projected >= self.fifo[-1][0] + self.measurement_interval:
-            self.fifo.append((epos_projected, self.diameter))
-            if self.logging:
-                self.gcode.respond_info("Filament diameter: %.2f" % self.diameter)
+        # the extruder has moved since the last update
+        active = epos != self._last_epos
+        self._last_epos = epos
         # check runout
-        filament_present = self.runout_min_diameter <= self.diameter <= self.runout_max_diameter;
+        filament_present = (self.runout_min_diameter <= diameter
+                            <= self.runout_max_diameter)
         self.runout_helper.note_filament_present(filament_present)
+        if filament_present != self._filament_present:
+            self._filament_present = filament_present
+            self._update_needed = True
+            active = True
+        # skip the update if no measurement is due, the FIFO head has not
+        # been reached and nothing else has changed
+        if (not self._update_needed
+            and epos_projected < self._next_epos_threshold
+            and epos < self._head_epos
+            and self.gcode_move.extrude_factor == self._extrude_factor):
+            return self._next_update_time(eventtime, active)
+        self._last_cb_diameter = diameter
+        self._update_needed = False
+        # append projected extruder position and diameter to FIFO tail if measurement interval has passed or FIFO is empty
+        if epos_projected >= self._next_epos_threshold:
+            if self._size == fifo_size:
+                # FIFO is full; drop the oldest entry
+                self._head = (self._head + 1) % fifo_size
+                self._size -= 1
+                self._head_epos = fifo_epos[self._head]
+            elif not self._size:
+                self._head_epos = epos_projected
+            fifo_epos[self._tail] = epos_projected
+            fifo_diam[self._tail] = diameter
+            self._tail = (self._tail + 1) % fifo_size
+            self._size += 1
+            self._next_epos_threshold = (epos_projected
+                                         + self.measurement_interval)
+            if self.logging:
+                self.gcode.respond_info("Filament diameter: %.2f" % diameter)
         if filament_present:
             # check if extruder position from FIFO head has been reached; FIFO is never empty here
-            if epos >= self.fifo[0][0]:
+            if epos >= self._head_epos:
                 # remove head entry from FIFO and use its diameter
-                diameter_to_use = self.fifo.pop(0)[1]
+                head = self._head
+                diameter_to_use = fifo_diam[head]
+                self._head = head = (head + 1) % fifo_size
+                self._size -= 1
+                if self._size:
+                    self._head_epos = fifo_epos[head]
+                else:
+                    self._clear_fifo()
+                # the next update falls back to the delay phase diameter
+                self._update_needed = True
             elif self.use_current_diameter_while_delay:
                 # use current diameter in delay phase
-                diameter_to_use = self.diameter
+                diameter_to_use = diameter
             else:
                 # use nominal diameter in delay phase
-                diameter_to_use = self.nominal_diameter
-            # use nominal diameter if determined diameter is out of bounds
-            if not self.min_diameter <= diameter_to_use <= self.max_diameter:
-                diameter_to_use = self.nominal_diameter
-            # update extrusion multiplier
-            self.gcode.run_script("M221 S%d" % round((self.nominal_diameter / diameter_to_use) ** 2 * 100))
+                diameter_to_use = nominal_diameter
+            m221 = self._m221_percentage(diameter_to_use)
         else:
             # filament not present; set extrusion multiplier to 100% and clear FIFO
-            self.gcode.run_script("M221 S100")
-            self.fifo = []
+            m221 = 100
+            self._clear_fifo()
+        # update extrusion multiplier if it differs from the current one
+        # (it may have been changed by M221 or RESTORE_GCODE_STATE)
+        extrude_factor = self._extrude_factor = m221 / 100.0
+        if extrude_factor != self.gcode_move.extrude_factor:
+            self.gcode_move.set_extrude_factor(extrude_factor)
+        return self._next_update_time(eventtime, active)
 
-        if self.enabled:
-            return eventtime + 1
+    def _m221_percentage(self, diameter):
+        # use nominal diameter if determined diameter is out of bounds
+        if not self.min_diameter <= diameter <= self.max_diameter:
+            diameter = self.nominal_diameter
+        return round(self._m221_num / (diameter * diameter))
+
+    def _next_update_time(self, eventtime, active):
+        # back off while idle, return to the regular interval on activity
+        if active:
+            self._idle_ticks = 0
         else:
-            return self.reactor.NEVER
+            self._idle_ticks += 1
+        return eventtime + min(self.idle_interval_max,
+                               UPDATE_TIME * (1 + self._idle_ticks))
+
+    def _clear_fifo(self):
+        self._head = self._tail = self._size = 0
+        self._next_epos_threshold = float('-inf')
+        self._head_epos = float('inf')
 
     def cmd_QUERY_FILAMENT_DIAMETER(self, gcmd):
         if self.runout_min_diameter <= self.diameter <= self.runout_max_diameter:
@@ -119,10 +228,15 @@ class FilaSense:
         gcmd.respond_info(response)
 
     def cmd_RESET_FILAMENT_DIAMETER_SENSOR(self, gcmd):
-        self.fifo = []
+        self._clear_fifo()
         gcmd.respond_info("Filament diameter measurements cleared!")
         # set extrusion multiplier to 100%
-        self.gcode.run_script_from_command("M221 S100")
+        self.gcode_move.set_extrude_factor(1.0)
+        self._update_needed = True
+        if self.enabled:
+            self._idle_ticks = 0
+            # restart extrusion multiplier update timer
+            self.reactor.update_timer(self.timer, self.reactor.NOW)
 
     def cmd_ENABLE_FILAMENT_DIAMETER_SENSOR(self, gcmd):
         if self.enabled:
@@ -130,6 +244,8 @@ class FilaSense:
         else:
             response = "Filament diameter sensor turned ON"
             self.enabled = True
+            self._idle_ticks = 0
+            self._update_needed = True
             # start extrusion multiplier update timer
             self.reactor.update_timer(self.timer, self.reactor.NOW)
         gcmd.respond_info(response)
@@ -143,9 +259,10 @@ class FilaSense:
             # stop extrusion multiplier update timer
             self.reactor.update_timer(self.timer, self.reactor.NEVER)
             # clear FIFO
-            self.fifo = []
+            self._clear_fifo()
             # set extrusion multiplier to 100%
-            self.gcode.run_script_from_command("M221 S100")
+            self.gcode_move.set_extrude_factor(1.0)
+            self._update_needed = True
         gcmd.respond_info(response)
 
     def cmd_QUERY_RAW_FILAMENT_DIAMETER(self, gcmd):
@@ -154,13 +271,16 @@ class FilaSense:
     def get_status(self, eventtime):
         return { 'diameter': self.diameter, 'raw': self.raw, 'enabled': self.enabled }
 
+    def _set_logging(self, gcmd, logging):
+        self.logging = logging
+        gcmd.respond_info("Filament diameter logging turned %s"
+                          % ("ON" if logging else "OFF"))
+
     def cmd_ENABLE_FILAMENT_DIAMETER_LOG(self, gcmd):
-        self.logging = True
-        gcmd.respond_info("Filament diameter logging turned ON")
+        self._set_logging(gcmd, True)
 
     def cmd_DISABLE_FILAMENT_DIAMETER_LOG(self, gcmd):
-        self.logging = False
-        gcmd.respond_info("Filament diameter logging turned OFF")
+        self._set_logging(gcmd, False)
 
 def load_config(config):
     return FilaSense(config)
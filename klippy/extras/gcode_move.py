@@ -179,13 +179,14 @@ class GCodeMove:
         value = gcmd.get_float('S', 100., above=0.) / (60. * 100.)
         self.speed = self._get_gcode_speed() * value
         self.speed_factor = value
-    def cmd_M221(self, gcmd):
-        # Set extrude factor override percentage
-        new_extrude_factor = gcmd.get_float('S', 100., above=0.) / 100.
+    def set_extrude_factor(self, new_extrude_factor):
         last_e_pos = self.last_position[3]
         e_value = (last_e_pos - self.base_position[3]) / self.extrude_factor
         self.base_position[3] = last_e_pos - e_value * new_extrude_factor
         self.extrude_factor = new_extrude_factor
+    def cmd_M221(self, gcmd):
+        # Set extrude factor override percentage
+        self.set_extrude_factor(gcmd.get_float('S', 100., above=0.) / 100.)
     cmd_SET_GCODE_OFFSET_help = "Set a virtual offset to g-code positions"
     def cmd_SET_GCODE_OFFSET(self, gcmd):
         move_delta = [0., 0., 0., 0.]